@@ -4,22 +4,39 @@
 # =========================================
 
 # Install dependencies
-!pip install dspy trafilatura pandas tqdm requests beautifulsoup4 python-dotenv
+!pip install dspy trafilatura tqdm aiohttp lxml python-dotenv sentence-transformers faiss-cpu rapidfuzz scipy tiktoken orjson
 
 # -----------------------------------------
 # 1. Imports
 # -----------------------------------------
+import io
+import csv
 import os
+import re
+import orjson
 import dspy
-import requests
-import pandas as pd
+import hashlib
+import time
+import threading
+import faiss
+import numpy as np
+import tiktoken
+import asyncio
+import aiohttp
 import trafilatura
 from tqdm import tqdm
-from bs4 import BeautifulSoup
+from lxml import etree
+from rapidfuzz import fuzz, process, utils
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from sentence_transformers import SentenceTransformer
 from urllib.parse import urlparse
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from dspy.utils.exceptions import AdapterParseError
 from typing import List
+from functools import lru_cache
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import random
 from dotenv import load_dotenv
 
@@ -38,7 +55,8 @@ os.environ["OPENAI_API_KEY"] = api_key
 os.environ["OPENAI_API_BASE"] = api_base
 
 # Configure DSPy with LongCat model
-dspy.configure(lm=dspy.LM("openai/LongCat-Flash-Chat"))
+LM_MODEL = "LongCat-Flash-Chat"
+dspy.configure(lm=dspy.LM(f"openai/{LM_MODEL}"))
 
 # -----------------------------------------
 # 3. Define Entity Extraction Signature
@@ -53,6 +71,76 @@ class ExtractEntities(dspy.Signature):
 
 extract_entities = dspy.Predict(ExtractEntities)
 
+class ExtractEntitiesBatch(dspy.Signature):
+    """Extract entities from each paragraph separately; return one list per paragraph, in order."""
+    paragraphs: List[str] = dspy.InputField()
+    entities_per_doc: List[List[EntityWithAttr]] = dspy.OutputField()
+
+extract_entities_batch = dspy.Predict(ExtractEntitiesBatch)
+
+ENCODING = tiktoken.get_encoding("cl100k_base")
+BATCH_SIZE = 4
+PARAGRAPH_TOKENS = 2048
+# Three full-size paragraphs; four only share a call when some of them are short
+BATCH_TOKENS = 6144
+
+def truncate_tokens(text, max_tokens=PARAGRAPH_TOKENS):
+    """Returns (text cut to max_tokens, its token count) so the count never needs re-encoding."""
+    tokens = ENCODING.encode(text)
+    if len(tokens) <= max_tokens:
+        return text, len(tokens)
+    return ENCODING.decode(tokens[:max_tokens]), max_tokens
+
+def batch_by_tokens(items, batch_size=BATCH_SIZE, max_tokens=BATCH_TOKENS):
+    """Group (key, paragraph, n_tokens) items into batches bounded by paragraph count and total tokens."""
+    batches, batch, used = [], [], 0
+    for key, paragraph, n_tokens in items:
+        if batch and (len(batch) == batch_size or used + n_tokens > max_tokens):
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append((key, paragraph, n_tokens))
+        used += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def robust_extract(text, retries=2):
+    """Per-paragraph extraction that feeds schema errors back to the LM; [] once retries run out."""
+    paragraph = text
+    for attempt in range(retries + 1):
+        try:
+            return extract_entities(paragraph=paragraph).entities
+        except (ValidationError, AdapterParseError) as err:
+            if attempt == retries:
+                print(f"  Extraction gave up after {retries + 1} attempts: {err}")
+                break
+            paragraph = (
+                f"{text}\n\n[Previous output had schema error: {err}. "
+                "Return only valid JSON matching List[EntityWithAttr].]"
+            )
+            time.sleep(1.0 * (attempt + 1))
+    return []
+
+def extract_batch(paragraphs):
+    """One LM call for several paragraphs; falls back to per-paragraph calls if the batch fails.
+
+    A paragraph whose own call still raises gets the exception in its slot, so it
+    fails alone instead of taking the rest of the batch with it.
+    """
+    try:
+        pred = extract_entities_batch(paragraphs=paragraphs)
+        if len(pred.entities_per_doc) == len(paragraphs):
+            return pred.entities_per_doc
+    except Exception as e:
+        print(f"  Batch extraction failed ({e}), retrying paragraphs one at a time")
+    results = []
+    for p in paragraphs:
+        try:
+            results.append(robust_extract(p))
+        except Exception as e:
+            results.append(e)
+    return results
+
 # -----------------------------------------
 # 4. Deduplication
 # -----------------------------------------
@@ -61,17 +149,201 @@ class DeduplicateEntities(dspy.Signature):
     deduplicated: List[str] = dspy.OutputField()
     confidence: float = dspy.OutputField()
 
+dedup_fast_predictor = dspy.Predict(DeduplicateEntities)
 dedup_predictor = dspy.ChainOfThought(DeduplicateEntities)
 
+class DeduplicateEntitiesBatch(dspy.Signature):
+    """Deduplicate each group of entity names separately; return one list per group, in order."""
+    groups: List[List[str]] = dspy.InputField()
+    deduplicated_per_group: List[List[str]] = dspy.OutputField()
+    confidence: float = dspy.OutputField()
+
+dedup_batch_predictor = dspy.ChainOfThought(DeduplicateEntitiesBatch)
+DEDUP_BATCH_SIZE = 8
+
+NEAR_DUPLICATE_SCORE = 85
+
 def deduplicate_with_lm(items, target_confidence=0.9):
-    for _ in range(3):
-        pred = dedup_predictor(items=items)
+    """Returns (deduplicated, confident); unconfident results should not be cached."""
+    # Cheap Predict first; escalate to Chain-of-Thought only if confidence is short
+    for predictor in (dedup_fast_predictor, dedup_predictor):
+        pred = predictor(items=items)
         if pred.confidence and pred.confidence >= target_confidence:
-            return pred.deduplicated
-    return list(set(items))
+            return pred.deduplicated, True
+    # Still unsure: union the LM output with the inputs, deduplicated case-insensitively
+    merged = {}
+    for e in [*pred.deduplicated, *items]:
+        merged.setdefault(e.strip().lower(), e.strip())
+    return list(merged.values()), False
+
+def deduplicate_batch_with_lm(groups, target_confidence=0.9):
+    """One LM call for several groups; falls back per group on a bad or low-confidence batch output."""
+    try:
+        pred = dedup_batch_predictor(groups=groups)
+        if (pred.confidence and pred.confidence >= target_confidence
+                and len(pred.deduplicated_per_group) == len(groups)):
+            return [(deduplicated, True) for deduplicated in pred.deduplicated_per_group]
+    except Exception as e:
+        print(f"  Batch dedup failed ({e}), retrying groups one at a time")
+    results = []
+    for g in groups:
+        try:
+            results.append(deduplicate_with_lm(g))
+        except Exception as e:
+            # Keep the cluster's own names rather than failing every URL that owns it
+            print(f"  Dedup failed for {g} ({e}), keeping names as-is")
+            results.append((list(g), False))
+    return results
+
+def cluster_entities(entities):
+    """Group candidate near-duplicate names locally; returns a tuple of names per cluster."""
+    # Collapse case/whitespace duplicates first
+    unique = {}
+    for e in entities:
+        unique.setdefault(e.entity.strip().lower(), e)
+    names = [e.entity.strip() for e in unique.values()]
+    if len(names) < 2:
+        return [tuple(names)] if names else []
+
+    # default_process also folds punctuation, so "COVID-19" and "COVID 19" land together
+    scores = process.cdist(
+        names, names, scorer=fuzz.token_sort_ratio, processor=utils.default_process, workers=-1
+    )
+    n_clusters, labels = connected_components(csr_matrix(scores >= NEAR_DUPLICATE_SCORE), directed=False)
+    return [tuple(names[i] for i in np.flatnonzero(labels == label)) for label in range(n_clusters)]
+
+def merge_clusters(clusters, resolved):
+    """Singletons pass through; every multi-name cluster takes the LM's resolution."""
+    deduped = []
+    for members in clusters:
+        if len(members) > 1:
+            deduped.extend(resolved[members])
+        else:
+            deduped.extend(members)
+    return deduped
+
+# -----------------------------------------
+# 5. Caching
+# -----------------------------------------
+CACHE_DIR = Path(".dspy_cache")
+PROMPT_VERSION = "v1"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SIMILARITY_THRESHOLD = 0.92
+# MiniLM reads at most 256 tokens, so paragraphs are embedded as word windows below that limit
+EMBEDDING_WINDOW_WORDS = 120
+# Shared site chrome can push cosine over the threshold; hits must also share most of their words
+MIN_WORD_OVERLAP = 0.8
+
+class ExtractionCache:
+    """Disk cache for LLM outputs, keyed by SHA-256 of model, prompt version and input."""
+
+    def __init__(self, cache_dir, namespace, load, dump=lambda value: value):
+        self.cache_dir = Path(cache_dir) / namespace
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.load = load
+        self.dump = dump
+
+    def key(self, text):
+        prefix = f"{LM_MODEL}\x00{PROMPT_VERSION}\x00".encode()
+        return hashlib.sha256(prefix + text.encode()).hexdigest()
+
+    def get(self, text):
+        path = self.cache_dir / f"{self.key(text)}.json"
+        if not path.exists():
+            return None
+        try:
+            return self.load(orjson.loads(path.read_bytes()))
+        except (ValueError, ValidationError):
+            # Stale or corrupt entry (e.g. schema changed) — evict so it is recomputed
+            path.unlink(missing_ok=True)
+            return None
+
+    def put(self, text, value):
+        path = self.cache_dir / f"{self.key(text)}.json"
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_bytes(orjson.dumps(self.dump(value), option=orjson.OPT_SERIALIZE_NUMPY))
+        os.replace(tmp, path)
+
+extraction_cache = ExtractionCache(
+    CACHE_DIR, "extract",
+    load=lambda data: [EntityWithAttr.model_validate(d) for d in data],
+    dump=lambda entities: [e.model_dump() for e in entities],
+)
+dedup_cache = ExtractionCache(CACHE_DIR, "dedup", load=TypeAdapter(List[str]).validate_python)
+
+def words_overlap(text_a, text_b, min_overlap=MIN_WORD_OVERLAP):
+    """Word-set Jaccard check that guards embedding matches against shared boilerplate."""
+    a, b = set(text_a.lower().split()), set(text_b.lower().split())
+    return len(a & b) >= min_overlap * len(a | b)
+
+class SemanticCache:
+    """Reuses extractions for near-duplicate paragraphs via embedding cosine similarity."""
+
+    def __init__(self, cache_dir, model_name=EMBEDDING_MODEL, threshold=SIMILARITY_THRESHOLD):
+        self.cache_dir = Path(cache_dir) / "semantic"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.cache_dir / "vectors.npy"
+        self.results_path = self.cache_dir / "results.jsonl"
+        self.threshold = threshold
+        self.model = SentenceTransformer(model_name)
+        self.index = faiss.IndexFlatIP(self.model.get_sentence_embedding_dimension())
+        self.results = []
+        if self.vectors_path.exists() and self.results_path.exists():
+            vectors = np.load(self.vectors_path)
+            results = [orjson.loads(line) for line in self.results_path.read_bytes().splitlines()]
+            if (len(vectors) == len(results) and vectors.shape[1] == self.index.d
+                    and all(isinstance(r, dict) for r in results)):
+                self.index.add(vectors)
+                self.results = results
+
+    def embed(self, texts):
+        """Embed the full text of each paragraph as the mean of its window vectors."""
+        windows, owners = [], []
+        for i, text in enumerate(texts):
+            words = text.split() or [""]
+            for start in range(0, len(words), EMBEDDING_WINDOW_WORDS):
+                windows.append(" ".join(words[start:start + EMBEDDING_WINDOW_WORDS]))
+                owners.append(i)
+        vectors = self.model.encode(windows, batch_size=32, normalize_embeddings=True)
+        owners = np.asarray(owners)
+        pooled = np.stack([vectors[owners == i].mean(axis=0) for i in range(len(texts))])
+        pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled.astype("float32")
+
+    def lookup(self, vector, text):
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(vector.reshape(1, -1), 1)
+        if scores[0][0] <= self.threshold:
+            return None
+        cached = self.results[ids[0][0]]
+        if not words_overlap(text, cached["text"]):
+            return None
+        try:
+            return [EntityWithAttr.model_validate(d) for d in cached["entities"]]
+        except (KeyError, ValidationError):
+            return None
+
+    def is_near_duplicate(self, vector_a, text_a, vector_b, text_b):
+        return float(vector_a @ vector_b) > self.threshold and words_overlap(text_a, text_b)
+
+    def add(self, vector, text, entities):
+        self.index.add(vector.reshape(1, -1))
+        self.results.append({"text": text, "entities": [e.model_dump() for e in entities]})
+
+    def save(self):
+        if self.index.ntotal == 0:
+            return
+        np.save(self.vectors_path, self.index.reconstruct_n(0, self.index.ntotal))
+        self.results_path.write_bytes(b"".join(orjson.dumps(r) + b"\n" for r in self.results))
+
+semantic_cache = SemanticCache(CACHE_DIR)
+
+def dedup_key(items):
+    return "\x00".join(sorted(items))
 
 # -----------------------------------------
-# 5. Relationship Generator
+# 6. Relationship Generator
 # -----------------------------------------
 def generate_semantic_relationships(entities):
     verbs = [
@@ -86,66 +358,222 @@ def generate_semantic_relationships(entities):
     return triples
 
 # -----------------------------------------
-# 6. Mermaid Generator
+# 7. Mermaid Generator
 # -----------------------------------------
+_TRANS = str.maketrans({" ": "_", "-": "_"})
+
+def _clean(s):
+    return s.translate(_TRANS)[:40]
+
 def triples_to_mermaid(triples, entity_list):
     entity_set = {e.strip().lower() for e in entity_list}
-    lines = ["graph TD"]
-    clean = lambda s: s.replace(" ", "_").replace("-", "_")[:40]
-    for src, lbl, dst in triples:
-        if src.lower() in entity_set and dst.lower() in entity_set:
-            lines.append(f"  {clean(src)} -- {lbl[:40]} --> {clean(dst)}")
-    return "\n".join(lines)
+    cleaned = {e: _clean(e) for e in entity_list}
+    edges = (
+        f"  {cleaned[src]} -- {lbl[:40]} --> {cleaned[dst]}"
+        for src, lbl, dst in triples
+        if src.lower() in entity_set and dst.lower() in entity_set
+    )
+    return "\n".join(["graph TD", *edges])
 
 # -----------------------------------------
-# 7. Fetch Functions
+# 8. Fetch Functions
 # -----------------------------------------
-def fetch_with_bs(url):
-    """Fallback: Use BeautifulSoup for plain text extraction."""
-    try:
-        headers = {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/120.0.0.0 Safari/537.36"
-            )
-        }
-        res = requests.get(url, headers=headers, timeout=20)
-        if res.status_code != 200:
-            print(f"  Fallback failed ({res.status_code}) for {url}")
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/120.0.0.0 Safari/537.36"
+    )
+}
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=20)
+FETCH_CONCURRENCY = 8
+POOL_SIZE = 16
+FETCH_RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = {502, 503, 504}
+# Domains Trafilatura cannot handle; one precompiled alternation instead of a substring loop
+BLOCKED_RE = re.compile(r"(nature\.com|sciencedirect\.com|ncbi\.nlm\.nih\.gov)")
+FALLBACK_MAX_BYTES = 200_000
+MAX_CONTENT_LENGTH = 5_000_000
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml")
+FALLBACK_MAX_CHARS = 10_000
+SKIP_TAGS = {"script", "style", "nav", "footer", "header"}
+# Skip Trafilatura's slower fallback extractors (formerly no_fallback=True) for speed-sensitive runs
+TRAFILATURA_FAST = os.getenv("TRAFILATURA_FAST", "0") == "1"
+
+@lru_cache(maxsize=4096)
+def _netloc(url):
+    """Lowercased host of a URL without userinfo or port, e.g. 'Nature.com:443' -> 'nature.com'."""
+    return urlparse(url).hostname or ""
+
+async def get_with_retry(session, url):
+    """GET over the pooled session, retrying connection errors and 5xx with backoff."""
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            res = await session.get(url, timeout=FETCH_TIMEOUT)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == FETCH_RETRIES:
+                raise
+        else:
+            if res.status not in RETRY_STATUSES or attempt == FETCH_RETRIES:
+                return res
+            res.release()
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+def is_html_response(res, url):
+    """Reject PDFs, images and oversized pages from the headers, before reading the body."""
+    content_type = res.headers.get("Content-Type", "").lower()
+    if not content_type.startswith(HTML_CONTENT_TYPES):
+        print(f"  Skipping non-HTML content ({content_type or 'unknown'}) for {url}")
+        return False
+    if int(res.headers.get("Content-Length") or 0) > MAX_CONTENT_LENGTH:
+        print(f"  Skipping oversized page ({res.headers['Content-Length']} bytes) for {url}")
+        return False
+    return True
+
+async def read_capped(res, limit=MAX_CONTENT_LENGTH):
+    """Read the body, or None once more than `limit` bytes arrive (chunked replies lack Content-Length)."""
+    buf = bytearray()
+    async for chunk in res.content.iter_chunked(65536):
+        buf.extend(chunk)
+        if len(buf) > limit:
             return None
-        soup = BeautifulSoup(res.text, "html.parser")
-        for tag in soup(["script", "style", "nav", "footer", "header"]):
-            tag.decompose()
-        text = " ".join(soup.get_text().split())
-        return text[:10000]
+    return bytes(buf)
+
+class VisibleTextTarget:
+    """lxml parser target that collects text outside script/style/nav/footer/header."""
+
+    def __init__(self):
+        self.skip_depth = 0
+        self.out = io.StringIO()
+        self.length = 0
+
+    def start(self, tag, attrib):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+
+    def end(self, tag):
+        if tag in SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def data(self, data):
+        if not self.skip_depth:
+            self.out.write(data)
+            self.length += len(" ".join(data.split()))
+
+    def close(self):
+        return self.out.getvalue()
+
+ENCODING_SNIFF_BYTES = 4096
+
+def _html_encoding(charset, head):
+    """Header charset if given; else let lxml honour a <meta> charset; else assume UTF-8."""
+    if charset:
+        return charset
+    if b"charset" in head[:ENCODING_SNIFF_BYTES].lower():
+        return None
+    return "utf-8"
+
+def _text_from_html(html, charset=None):
+    """Fallback text extraction from already-downloaded HTML bytes (no second GET)."""
+    if not html:
+        return None
+    target = VisibleTextTarget()
+    parser = etree.HTMLParser(target=target, encoding=_html_encoding(charset, html))
+    for start in range(0, len(html), 65536):
+        parser.feed(html[start:start + 65536])
+        if target.length >= FALLBACK_MAX_CHARS:
+            break
+    return truncate_tokens(" ".join(parser.close().split()))
+
+async def fetch_with_lxml(session, url):
+    """Fallback: Stream the page through lxml's tokenizer for plain text extraction."""
+    try:
+        target = VisibleTextTarget()
+        parser = None
+        async with await get_with_retry(session, url) as res:
+            if res.status != 200:
+                print(f"  Fallback failed ({res.status}) for {url}")
+                return None
+            if not is_html_response(res, url):
+                res.close()
+                return None
+            # Feed chunks as they arrive and stop once we have enough visible text.
+            # The first few KB are buffered so a <meta> charset is seen before picking an encoding.
+            head = bytearray()
+            received = 0
+            async for chunk in res.content.iter_chunked(65536):
+                received += len(chunk)
+                if parser is None:
+                    head.extend(chunk)
+                    if len(head) < ENCODING_SNIFF_BYTES:
+                        continue
+                    parser = etree.HTMLParser(target=target, encoding=_html_encoding(res.charset, head))
+                    chunk = bytes(head)
+                parser.feed(chunk)
+                if target.length >= FALLBACK_MAX_CHARS or received >= FALLBACK_MAX_BYTES:
+                    break
+            charset = res.charset
+        if parser is None:
+            # Body ended before the sniff window filled
+            if not head:
+                return None
+            parser = etree.HTMLParser(target=target, encoding=_html_encoding(charset, head))
+            parser.feed(bytes(head))
+        text = " ".join(parser.close().split())
+        return truncate_tokens(text)
     except Exception as e:
         print(f"  Fallback error for {url}: {e}")
         return None
 
-def fetch_text_from_url(url):
-    """Try Trafilatura first, then fallback."""
-    domain = urlparse(url).netloc
-    blocked_domains = ["nature.com", "sciencedirect.com", "ncbi.nlm.nih.gov"]
+async def fetch_text_from_url(session, url):
+    """Try Trafilatura first, then fallback. Returns (text, n_tokens) or None."""
+    domain = _netloc(url)
 
     try:
-        if any(b in domain for b in blocked_domains):
+        if BLOCKED_RE.search(domain):
             print(f" Domain {domain} blocked for Trafilatura — using fallback.")
-            return fetch_with_bs(url)
+            return await fetch_with_lxml(session, url)
 
-        downloaded = trafilatura.fetch_url(url)
-        if downloaded:
-            extracted = trafilatura.extract(downloaded, include_comments=False)
-            if extracted and len(extracted.strip()) > 200:
-                return extracted
+        # One GET serves both Trafilatura and the lxml fallback
+        async with await get_with_retry(session, url) as res:
+            if res.status != 200:
+                print(f"  Fetch failed ({res.status}) for {url}")
+                return None
+            if not is_html_response(res, url):
+                res.close()
+                return None
+            html = await read_capped(res)
+            if html is None:
+                print(f"  Skipping oversized page (over {MAX_CONTENT_LENGTH} bytes) for {url}")
+                res.close()
+                return None
+            charset = res.charset
+        # Parsing is CPU-bound; run it off the event loop so other fetches keep flowing
+        extracted = await asyncio.to_thread(
+            trafilatura.extract, html, include_comments=False, fast=TRAFILATURA_FAST
+        )
+        if extracted and len(extracted.strip()) > 200:
+            return truncate_tokens(extracted)
         print(f" Trafilatura failed for {url}, using fallback.")
-        return fetch_with_bs(url)
+        return await asyncio.to_thread(_text_from_html, html, charset)
     except Exception as e:
         print(f"  Error fetching {url}: {e}")
         return None
 
+async def fetch_all(urls):
+    """Fetch every URL concurrently over one shared session."""
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    # Keep-alive connection pool shared by every fetch, so repeat hosts skip the TLS handshake
+    connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=30)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        async def bounded_fetch(url):
+            async with semaphore:
+                return await fetch_text_from_url(session, url)
+        return await asyncio.gather(*(bounded_fetch(u) for u in urls))
+
 # -----------------------------------------
-# 8. Main Pipeline
+# 9. Main Pipeline
 # -----------------------------------------
 urls = [
     "https://en.wikipedia.org/wiki/Sustainable_agriculture",
@@ -160,46 +588,159 @@ urls = [
     "https://www.theguardian.com/global-development/2025/oct/13/astro-ambassadors-stargazers-himalayas-hanle-ladakh-india",
 ]
 
+LLM_WORKERS = 8
+
+pages = asyncio.run(fetch_all(urls))
+extracted, deduped, errors = {}, {}, {}
+
+# Reuse extractions of near-duplicate paragraphs before paying for an LLM call
+fetched = {url: page[0] for url, page in zip(urls, pages) if page and page[0]}
+token_counts = {url: page[1] for url, page in zip(urls, pages) if page}
+vectors = dict(zip(fetched, semantic_cache.embed(list(fetched.values())))) if fetched else {}
+pending = {}
+for url, text in fetched.items():
+    hit = semantic_cache.lookup(vectors[url], text)
+    if hit is not None:
+        extracted[url] = hit
+    else:
+        pending[url] = text
+
+# Near-duplicates within this run share one extraction: only the first of each group is sent
+representatives, aliases = [], {}
+for url in pending:
+    for rep_url in representatives:
+        if semantic_cache.is_near_duplicate(vectors[url], pending[url], vectors[rep_url], pending[rep_url]):
+            aliases[url] = rep_url
+            break
+    else:
+        representatives.append(url)
+for url in aliases:
+    del pending[url]
+
+with ThreadPoolExecutor(max_workers=LLM_WORKERS) as executor:
+    # Exact-match cache hits skip the LM; misses are batched several paragraphs per call
+    misses = []
+    for url, text in pending.items():
+        cached = extraction_cache.get(text)
+        if cached is not None:
+            extracted[url] = cached
+        else:
+            # Fetched text is already trimmed to PARAGRAPH_TOKENS; reuse its token count
+            misses.append((url, text, token_counts[url]))
+
+    futures = {
+        executor.submit(extract_batch, [paragraph for _, paragraph, _ in batch]): batch
+        for batch in batch_by_tokens(misses)
+    }
+    for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting entities"):
+        batch = futures[future]
+        try:
+            entities_per_doc = future.result()
+        except Exception as e:
+            for url, _, _ in batch:
+                errors[url] = e
+            continue
+        for (url, _, _), entities in zip(batch, entities_per_doc):
+            if isinstance(entities, Exception):
+                errors[url] = entities
+                continue
+            extracted[url] = entities
+            # Empty results may be exhausted retries; don't pin them in the caches
+            if entities:
+                extraction_cache.put(pending[url], entities)
+
+    for url, rep_url in aliases.items():
+        if rep_url in extracted:
+            extracted[url] = extracted[rep_url]
+        elif rep_url in errors:
+            errors[url] = errors[rep_url]
+
+    for url in pending:
+        if extracted.get(url):
+            semantic_cache.add(vectors[url], pending[url], extracted[url])
+    semantic_cache.save()
+
+    # Cluster locally; the LM confirms every multi-name cluster, batched across all URLs.
+    # Fuzzy scores alone can't tell "Type 1 diabetes" from "Type 2 diabetes".
+    clusters = {url: cluster_entities(entities) for url, entities in extracted.items()}
+    resolved, dedup_errors, groups = {}, {}, []
+    for url_clusters in clusters.values():
+        for members in url_clusters:
+            if len(members) < 2 or members in resolved:
+                continue
+            resolved[members] = dedup_cache.get(dedup_key(members))
+            if resolved[members] is None:
+                groups.append(members)
+
+    futures = {
+        executor.submit(deduplicate_batch_with_lm, [list(m) for m in chunk]): chunk
+        for chunk in (groups[i:i + DEDUP_BATCH_SIZE] for i in range(0, len(groups), DEDUP_BATCH_SIZE))
+    }
+    for future in tqdm(as_completed(futures), total=len(futures), desc="Deduplicating entities"):
+        chunk = futures[future]
+        try:
+            deduplicated_per_group = future.result()
+        except Exception as e:
+            for members in chunk:
+                dedup_errors[members] = e
+            continue
+        for members, (deduplicated, confident) in zip(chunk, deduplicated_per_group):
+            resolved[members] = deduplicated
+            # Like empty extractions, low-confidence fallbacks are retried on the next run
+            if confident:
+                dedup_cache.put(dedup_key(members), deduplicated)
+
+    for url, url_clusters in clusters.items():
+        failed = [dedup_errors[m] for m in url_clusters if m in dedup_errors]
+        if failed:
+            errors[url] = failed[0]
+        else:
+            deduped[url] = merge_clusters(url_clusters, resolved)
+
 results = []
+outputs = []
 
-for i, url in enumerate(tqdm(urls, desc="Processing URLs")):
+for i, url in enumerate(urls):
     print(f"\n🔎 [{i+1}/{len(urls)}] Processing URL: {url}")
+    mermaid_file = Path(f"mermaid_{i+1:02}.md")
     try:
-        text = fetch_text_from_url(url)
-        if not text:
+        if url in errors:
+            raise errors[url]
+        if url not in deduped:
             raise ValueError("Empty or blocked content")
 
-        entity_output = extract_entities(paragraph=text)
-        raw_entities = [e.entity for e in entity_output.entities]
-        raw_types = [e.attr_type for e in entity_output.entities]
+        raw_entities = [e.entity for e in extracted[url]]
+        raw_types = [e.attr_type for e in extracted[url]]
 
-        deduped_entities = deduplicate_with_lm(raw_entities)
+        deduped_entities = deduped[url]
         triples = generate_semantic_relationships(deduped_entities)
-        mermaid_str = triples_to_mermaid(triples, deduped_entities)
-
-        mermaid_file = Path(f"mermaid_{i+1:02}.md")
-        with open(mermaid_file, "w", encoding="utf-8") as f:
-            f.write(mermaid_str)
-        print(f" Mermaid diagram saved as {mermaid_file.name}")
+        outputs.append((mermaid_file, triples_to_mermaid(triples, deduped_entities)))
+        print(f" Mermaid diagram ready for {mermaid_file.name}")
 
         for e, t in zip(raw_entities, raw_types):
             results.append({"link": url, "tag": e, "tag_type": t})
 
     except Exception as e:
-        error_file = Path(f"mermaid_{i+1:02}.md")
-        with open(error_file, "w", encoding="utf-8") as f:
-            f.write("```mermaid\n")
-            f.write("graph TD\n")
-            f.write(f"A[URL Index {i+1}] -->|❌ Failed| B[{url}]\n")
-            f.write(f"B --> C[Error: {str(e).split(':')[0]}]\n")
-            f.write("classDef error fill:#f88,stroke:#800,stroke-width:2px;\n")
-            f.write("class B,C error;\n")
-            f.write("```")
-        print(f" Saved error Mermaid as {error_file.name}")
-
-# -----------------------------------------
-# 9. Save Output
-# -----------------------------------------
-df = pd.DataFrame(results)
-df.to_csv("tags.csv", index=False)
+        outputs.append((mermaid_file, (
+            "```mermaid\n"
+            "graph TD\n"
+            f"A[URL Index {i+1}] -->|❌ Failed| B[{url}]\n"
+            f"B --> C[Error: {str(e).split(':')[0]}]\n"
+            "classDef error fill:#f88,stroke:#800,stroke-width:2px;\n"
+            "class B,C error;\n"
+            "```"
+        )))
+        print(f" Error Mermaid ready for {mermaid_file.name}")
+
+# -----------------------------------------
+# 10. Save Output
+# -----------------------------------------
+# All file I/O happens once, off the fetch/LLM critical path
+with ThreadPoolExecutor(max_workers=8) as executor:
+    list(executor.map(lambda kv: kv[0].write_text(kv[1], encoding="utf-8"), outputs))
+
+with open("tags.csv", "w", newline="", encoding="utf-8") as f:
+    writer = csv.DictWriter(f, fieldnames=["link", "tag", "tag_type"])
+    writer.writeheader()
+    writer.writerows(results)
 print("\n Processing complete! All mermaid_XX.md and tags.csv saved.")